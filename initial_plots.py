@@ -20,17 +20,139 @@
 #
 # Last modified: July 31, 2024
 
-import pandas as pd
 import numpy as np
-import geopandas as gpd
-import matplotlib.pyplot as plt
-import scipy
-from scipy.stats import linregress
+from matplotlib.figure import Figure
 import os
-import seaborn as sns
 import pathlib
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from collections import namedtuple
 
-def main():
+# Plots are saved as WebP, which encodes faster than PNG (libpng + zlib) and gives smaller files for flat-coloured plots
+PLOT_EXT = '.webp'
+PLOT_PIL_KWARGS = {'quality': 85}
+
+LinregressResult = namedtuple('LinregressResult', ['slope', 'intercept', 'rvalue', 'pvalue', 'stderr', 'intercept_stderr'])
+
+# Means and centered sums of squares/products of every column of X against y
+def centered_sums(X, y):
+    xm = X.mean(axis=0)
+    ym = y.mean()
+    Xc = X - xm
+    yc = y - ym
+    return xm, ym, Xc.T @ yc, (Xc * Xc).sum(axis=0), yc @ yc
+
+# Same statistics as scipy.stats.linregress, but for every column of X against y at once
+# https://github.com/scipy/scipy/blob/main/scipy/stats/_stats_py.py (linregress)
+def linregress_columns(X, y):
+    from scipy.stats import t as t_dist  # imported here since scipy.stats is slow to import
+
+    n = X.shape[0]
+    xm, ym, Sxy, Sxx, Syy = centered_sums(X, y)
+    # Same error scipy raises, instead of dividing by zero and writing nan statistics
+    if np.any(Sxx == 0):
+        raise ValueError("Cannot calculate a linear regression if all x values are identical")
+
+    slope = Sxy / Sxx
+    intercept = ym - slope*xm
+    r = np.clip(Sxy / np.sqrt(Sxx*Syy), -1.0, 1.0)
+
+    # Two-sided p-value from the t-distribution, same as scipy (TINY avoids division by zero when |r| = 1)
+    df = n - 2
+    TINY = 1.0e-20
+    t = r * np.sqrt(df / ((1.0 - r + TINY)*(1.0 + r + TINY)))
+    pvalue = 2 * t_dist.sf(np.abs(t), df)
+    stderr = np.sqrt((1 - r**2) * Syy / Sxx / df)
+    intercept_stderr = stderr * np.sqrt(Sxx/n + xm**2)
+    return LinregressResult(slope, intercept, r, pvalue, stderr, intercept_stderr)
+
+# Load the cleaned demographic features (one column per feature), crime counts and log(crime counts) for a city as NumPy arrays
+# Reading the geojson is the slowest part of preprocessing, so the cleaned columns are cached as a .npz
+# keyed by the input file's mtime and size, and reused until the input file or the requested columns change
+def load_city_data(path, y, demographics):
+    stat = os.stat(path)
+    key = f'{path.name}-{stat.st_mtime_ns}-{stat.st_size}'
+    cache_dir = os.path.join('initial_plots', '.cache')
+    cache_file = os.path.join(cache_dir, key + '.npz')
+
+    if os.path.exists(cache_file):
+        try:
+            with np.load(cache_file) as cached:
+                if cached['target'] == y and list(cached['demographics']) == demographics:
+                    return cached['X'], cached['y'], cached['logy']
+        except (zipfile.BadZipFile, OSError, KeyError, ValueError):
+            pass  # unreadable (e.g. truncated) or outdated cache, rebuild it
+
+    # geopandas is slow to import and only needed when the cache misses
+    import geopandas as gpd
+
+    # Only the demographic features and crime counts are used, so the geometry is dropped
+    data = gpd.read_file(path, engine='pyogrio')
+    data = data.dropna(subset=demographics)
+    X = data[demographics].to_numpy(dtype=np.float64)
+    y_arr = data[y].to_numpy(dtype=np.float64)
+    logy_arr = np.log(y_arr + 0.0000001)  # Transform crime by the log, adding a small constant to avoid log(0)
+
+    # Write to a temporary file first so an interrupted write never leaves a truncated cache behind
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_file = os.path.join(cache_dir, f'{key}.{os.getpid()}.tmp')
+    try:
+        with open(tmp_file, 'wb') as file:
+            np.savez_compressed(file, X=X, y=y_arr, logy=logy_arr, target=np.array(y), demographics=np.array(demographics))
+        os.replace(tmp_file, cache_file)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+    return X, y_arr, logy_arr
+
+# Scatter plots of crime count and log(crime count) vs one demographic feature with their linear regressions,
+# and a txt file with the regression statistics. One call per demographic feature, possibly in a worker process
+def plot_feature(city_folder, x, y, x_arr, y_arr, logy_arr, fit, fit_logcrime):
+    # Figure is used directly instead of pyplot so worker processes never import pyplot or touch a GUI backend
+    # One figure is reused for both plots instead of allocating a new canvas per plot
+    fig = Figure(figsize=(10,5))
+    ax = fig.subplots()
+
+    # Create a scatter plot of crime count vs some demographic feature with a linear regression
+    prediction = x_arr*fit.slope + fit.intercept
+    ax.plot(x_arr, y_arr, 'b.', alpha=0.5)
+    ax.plot(x_arr, prediction, 'r-', linewidth=1)
+    ax.grid(color='grey', linestyle='-', linewidth=0.5)
+    ax.set_xlabel(x)
+    ax.set_ylabel(y)
+    ax.set_title(f'Scatter Plot for ({x}, {y})', fontsize=20)
+    saved_plot = os.path.join(city_folder, x + '_scatter' + PLOT_EXT)
+    fig.savefig(saved_plot, pil_kwargs=PLOT_PIL_KWARGS)
+
+    # Create a scatter plot of log(crime count) vs some demographic feature with a linear regression
+    prediction = x_arr*fit_logcrime.slope + fit_logcrime.intercept
+    ax.cla()
+    ax.plot(x_arr, logy_arr, 'b.', alpha=0.5)
+    ax.plot(x_arr, prediction, 'r-', linewidth=1)
+    ax.grid(color='grey', linestyle='-', linewidth=0.5)
+    ax.set_xlabel(x)
+    ax.set_ylabel('log_' + y)
+    ax.set_title(f'Scatter Plot for ({x}, log({y}))', fontsize=20)
+    saved_plot = os.path.join(city_folder, x + '_logcrime_scatter' + PLOT_EXT)
+    fig.savefig(saved_plot, pil_kwargs=PLOT_PIL_KWARGS)
+
+    # Some (maybe) useful information we get from the linear regression
+    saved_linregress = os.path.join(city_folder, x + '_linregress' + '.txt')
+    with open(saved_linregress, 'w') as file:
+        file.write(f'Information we get from the linear regression for ({x}, {y})\n')
+        file.write(f'{"Correlation coefficient:":<25}{fit.rvalue:>10.6f}\n')
+        file.write(f'{"p-value:":<25}{fit.pvalue:>10.6f}\n')
+        file.write(f'{"Error of slope:":<25}{fit.stderr:>10.6f}\n')
+        file.write(f'{"Error of intercept:":<25}{fit.intercept_stderr:>10.6f}\n\n')
+
+        file.write(f'Information we get from the linear regression for ({x}, log({y}))\n')
+        file.write(f'{"Correlation coefficient:":<25}{fit_logcrime.rvalue:>10.6f}\n')
+        file.write(f'{"p-value:":<25}{fit_logcrime.pvalue:>10.6f}\n')
+        file.write(f'{"Error of slope:":<25}{fit_logcrime.stderr:>10.6f}\n')
+        file.write(f'{"Error of intercept:":<25}{fit_logcrime.intercept_stderr:>10.6f}\n')
+
+def main(workers=1):
     cities = ['van']
     y = 'crime_rate'
     demographics = ['pop_density', 'dropouts_to_grads', 'one_parent_to_two', 'crowded_to_not', 
@@ -42,84 +164,63 @@ def main():
         os.makedirs(city_folder, exist_ok=True)
         filename = 'crime_census_' + city + '.geojson'
         input_dir = pathlib.Path('crime_census')
-        data = gpd.read_file(input_dir / filename)
+        X, y_arr, logy_arr = load_city_data(input_dir / filename, y, demographics)
 
         # Create a box plot. Shows the median, quartiles, range, outliers of crime counts for each city
-        plt.figure(figsize=(10,5))
-        data = data.dropna(subset=demographics)
-        plt.boxplot(data[y], notch=True, vert=False)
-        plt.title(f'Box Plot for {y} in {city}')
-        saved_boxplot = os.path.join(city_folder, city + '_boxplot' + '.png')
-        plt.savefig(saved_boxplot)
-        plt.close()
+        fig = Figure(figsize=(10,5))
+        ax = fig.subplots()
+        ax.boxplot(y_arr, notch=True, vert=False)
+        ax.set_title(f'Box Plot for {y} in {city}')
+        saved_boxplot = os.path.join(city_folder, city + '_boxplot' + PLOT_EXT)
+        fig.savefig(saved_boxplot, pil_kwargs=PLOT_PIL_KWARGS)
 
         # Create a histogram to look at the rougth shape of the distribution of crime counts for each city
-        plt.figure(figsize=(10,5))
-        plt.hist(data[y])
-        plt.title(f'Histogram for {y} in {city}')
-        saved_hist = os.path.join(city_folder, city + '_hist' + '.png')
-        plt.savefig(saved_hist)
-        plt.close()
-
-        for x in demographics:
-            # Transform crime by the log
-            data['log_' + y] = np.log(data[y] + 0.0000001)  # Adding 1 to avoid log(0)
-
-            # Create a scatter plot of crime count vs some demographic feature with a linear regression
-            fit = linregress(data[x], data[y])
-            data['prediction'] = data[x]*fit.slope + fit.intercept
-            plt.figure(figsize=(10,5))
-            plt.plot(data[x], data[y], 'b.', alpha=0.5)
-            plt.plot(data[x], data['prediction'], 'r-', linewidth=1)
-            plt.grid(color='grey', linestyle='-', linewidth=0.5)
-            plt.xlabel(x)
-            plt.ylabel(y)
-            plt.title(f'Scatter Plot for ({x}, {y})', fontsize=20)
-            saved_plot = os.path.join(city_folder, x + '_scatter' + '.png')
-            plt.savefig(saved_plot)
-            plt.close()
-
-            # Create a scatter plot of log(crime count) vs some demographic feature with a linear regression
-            fit_logcrime = linregress(data[x], data['log_' + y])
-            data['prediction'] = data[x]*fit_logcrime.slope + fit_logcrime.intercept
-            plt.figure(figsize=(10,5))
-            plt.plot(data[x], data['log_' + y], 'b.', alpha=0.5)
-            plt.plot(data[x], data['prediction'], 'r-', linewidth=1)
-            plt.grid(color='grey', linestyle='-', linewidth=0.5)
-            plt.xlabel(x)
-            plt.ylabel('log_' + y)
-            plt.title(f'Scatter Plot for ({x}, log({y}))', fontsize=20)
-            saved_plot = os.path.join(city_folder, x + '_logcrime_scatter' + '.png')
-            plt.savefig(saved_plot)
-            plt.close()
-
-            # Some (maybe) useful information we get from the linear regression
-            saved_linregress = os.path.join(city_folder, x + '_linregress' + '.txt')
-            with open(saved_linregress, 'w') as file:
-                file.write(f'Information we get from the linear regression for ({x}, {y})\n')
-                file.write(f'{"Correlation coefficient:":<25}{fit.rvalue:>10.6f}\n')
-                file.write(f'{"p-value:":<25}{fit.pvalue:>10.6f}\n')
-                file.write(f'{"Error of slope:":<25}{fit.stderr:>10.6f}\n')
-                file.write(f'{"Error of intercept:":<25}{fit.intercept_stderr:>10.6f}\n\n')
-
-                file.write(f'Information we get from the linear regression for ({x}, log({y}))\n')
-                file.write(f'{"Correlation coefficient:":<25}{fit_logcrime.rvalue:>10.6f}\n')
-                file.write(f'{"p-value:":<25}{fit_logcrime.pvalue:>10.6f}\n')
-                file.write(f'{"Error of slope:":<25}{fit_logcrime.stderr:>10.6f}\n')
-                file.write(f'{"Error of intercept:":<25}{fit_logcrime.intercept_stderr:>10.6f}\n')
+        fig = Figure(figsize=(10,5))
+        ax = fig.subplots()
+        ax.hist(y_arr)
+        ax.set_title(f'Histogram for {y} in {city}')
+        saved_hist = os.path.join(city_folder, city + '_hist' + PLOT_EXT)
+        fig.savefig(saved_hist, pil_kwargs=PLOT_PIL_KWARGS)
+
+        # Linear regression of crime count and log(crime count) against every demographic feature at once
+        # Split into one LinregressResult per demographic feature
+        fits = [LinregressResult(*stats) for stats in zip(*linregress_columns(X, y_arr))]
+        fits_logcrime = [LinregressResult(*stats) for stats in zip(*linregress_columns(X, logy_arr))]
+
+        # The scatter plots for each demographic feature are independent, so they can be drawn in a process pool
+        # (workers > 1). Serial is the default since the pool's speedup hasn't been measured on a multi-core machine,
+        # and on a single CPU its startup cost makes it slower than a plain loop. Where workers are spawned
+        # (macOS, Windows), the pool needs main() to be run from a real file rather than stdin or a notebook
+        feature_args = (repeat(city_folder), demographics, repeat(y), X.T, repeat(y_arr), repeat(logy_arr),
+                        fits, fits_logcrime)
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=min(workers, len(demographics))) as executor:
+                list(executor.map(plot_feature, *feature_args))
+        else:
+            for args in zip(*feature_args):
+                plot_feature(*args)
 
         # Create a correlation matrix for the demographic features and log(crime count)
-        # https://www.geeksforgeeks.org/how-to-create-a-seaborn-correlation-heatmap-in-python/
-        plt.figure(figsize=(10, 10))
-        corr_matrix = data[['log_' + y] + demographics]
-        # Generate a mask for the upper triangle
-        mask = np.triu(np.ones_like(corr_matrix.corr(), dtype=bool))
-        sns.heatmap(corr_matrix.corr(), mask = mask, annot=True, cmap='coolwarm', vmin=-1, vmax=1)
-        plt.title(f'Correlation matrix for {city}')
-        plt.tight_layout()
-        saved_corr_matrix = os.path.join(city_folder, city + '_correlation_matrix' + '.png')
-        plt.savefig(saved_corr_matrix)
-        plt.close()
+        # Drawn with imshow and a text annotation per cell, which is much cheaper than seaborn's heatmap
+        fig = Figure(figsize=(10, 10))
+        ax = fig.subplots()
+        corr_cols = ['log_' + y] + demographics
+        corr = np.corrcoef(np.column_stack((logy_arr, X)), rowvar=False)
+        # Generate a mask for the upper triangle (masked cells are NaN, so they are left blank)
+        mask = np.triu(np.ones_like(corr, dtype=bool))
+        image = ax.imshow(np.where(mask, np.nan, corr), cmap='coolwarm', vmin=-1, vmax=1)
+        fig.colorbar(image, ax=ax, fraction=0.046, pad=0.04)
+        ax.set_xticks(range(len(corr_cols)))
+        ax.set_yticks(range(len(corr_cols)))
+        ax.set_xticklabels(corr_cols, rotation=45, ha='right')
+        ax.set_yticklabels(corr_cols)
+        for i in range(len(corr_cols)):
+            for j in range(i):
+                ax.text(j, i, f'{corr[i, j]:.2f}', ha='center', va='center')
+        ax.set_title(f'Correlation matrix for {city}')
+        fig.tight_layout()
+        saved_corr_matrix = os.path.join(city_folder, city + '_correlation_matrix' + PLOT_EXT)
+        fig.savefig(saved_corr_matrix, pil_kwargs=PLOT_PIL_KWARGS)
 
     return
 
@@ -11,34 +11,64 @@
 
 import pathlib
 import os
+import json
 import pandas as pd
 import geopandas as gpd
 # from operator import ne
 # from shapely.ops import unary_union
 import numpy as np
-import folium
-from folium import Choropleth
+
+# Load columns of the zipped crime CSV
+# Parsing the zipped CSV is slow, so it is converted to parquet once and later runs load that instead
+# The parquet file is keyed by the zip's mtime and size, so it is rebuilt whenever the zip changes
+def load_crime_data(crime_zip, columns):
+    stat = os.stat(crime_zip)
+    key = f'{crime_zip.stem}-{stat.st_mtime_ns}-{stat.st_size}'
+    cache_dir = crime_zip.parent / '.cache'
+    cache_file = cache_dir / (key + '.parquet')
+
+    if cache_file.exists():
+        try:
+            return pd.read_parquet(cache_file, columns=columns)
+        except (OSError, ValueError):
+            pass  # unreadable (e.g. truncated) cache, convert the zip again
+
+    data = pd.read_csv(crime_zip, compression = 'zip', engine='pyarrow')
+
+    # Write to a temporary file first so an interrupted write never leaves a truncated cache behind
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_file = cache_dir / f'{key}.{os.getpid()}.tmp'
+    try:
+        data.to_parquet(tmp_file)
+        os.replace(tmp_file, cache_file)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+    return data[columns]
 
 def main():
+    # folium is slow to import, so it is only imported when the map is built
+    import folium
+    from folium import Choropleth
+
     # Load the crime data
     input_dir = pathlib.Path('datasets')
-    data = pd.read_csv(input_dir / 'crimedata_van.zip', compression = 'zip')
+    # Only the neighbourhood and year are needed, so skip loading the other columns
+    data = load_crime_data(input_dir / 'crimedata_van.zip', ['NEIGHBOURHOOD', 'YEAR'])
+    data['YEAR'] = data['YEAR'].astype('int16')
 
     # Rename {Central Business District: Downtown, Musqueam: Dunbar Southlands}
+    # Stored as a category so later comparisons and counting don't hash every string
     data['NEIGHBOURHOOD'] = data['NEIGHBOURHOOD'].replace({
         'Central Business District': 'Downtown',
         'Musqueam': 'Dunbar Southlands'
-    })
-
-    # Drop Stanley Park
-    data = data[data['NEIGHBOURHOOD'] != 'Stanley Park']
+    }).astype('category')
 
-    # Keep only 2021 data to match the census data
-    data = data[data['YEAR'] == 2021]
+    # Drop Stanley Park and keep only 2021 data to match the census data
+    data = data[(data['YEAR'] == 2021) & (data['NEIGHBOURHOOD'] != 'Stanley Park')]
 
     # Only care about the neighbourhood and how many crimes occurred in that neighbourhood (2 columns)
-    crime_counts = data['NEIGHBOURHOOD'].value_counts().reset_index()  # count number of occurrences
-    crime_counts.columns = ['NEIGHBOURHOOD', 'CRIME_COUNT']  # rename columns
+    crime_counts = data.groupby('NEIGHBOURHOOD', observed=True).size().rename('CRIME_COUNT').reset_index()  # count number of occurrences
 
 
     # # NEW VANCOUVER.GEOJSON CONTAINS BETTER REGION BOUNDARIES, NO NEED TO JOIN GEOMETRY :)
@@ -79,14 +109,15 @@ def main():
     # Load the Vancouver neighborhoods GeoJSON file
     # https://opendata.vancouver.ca/explore/dataset/local-area-boundary/information/?disjunctive.name
     # neighborhoods = gpd.read_file('vancouver_combined.geojson')
-    neighborhoods = gpd.read_file(input_dir / 'vancouver.geojson')
+    # Only the neighbourhood name and geometry are used, so skip decoding the other attributes
+    neighborhoods = gpd.read_file(input_dir / 'vancouver.geojson', engine='pyogrio', columns=['name'])
 
     # Rename the GeoJSON 'name' column to 'NEIGHBOURHOOD' to match the crime data
     neighborhoods = neighborhoods.rename(columns={'name': 'NEIGHBOURHOOD'})
 
-    # Merge the crime counts with the GeoDataFrame
-    neighborhoods = neighborhoods.merge(crime_counts, on='NEIGHBOURHOOD', how='left')
-    neighborhoods['CRIME_COUNT'] = neighborhoods['CRIME_COUNT'].fillna(0)
+    # Add the crime counts to the GeoDataFrame (a dict lookup is cheaper than a merge for so few neighbourhoods)
+    counts_map = dict(zip(crime_counts['NEIGHBOURHOOD'], crime_counts['CRIME_COUNT']))
+    neighborhoods['CRIME_COUNT'] = neighborhoods['NEIGHBOURHOOD'].map(counts_map).fillna(0).astype('int32')
 
     # Create a folium map centered on Vancouver
     # https://python-visualization.github.io/folium/latest/user_guide/geojson/geojson_popup_and_tooltip.html
@@ -94,15 +125,21 @@ def main():
 
     # Values for scaling colour in choropleth layer
     # Using the logarithmic scale to better display choropleth information
-    neighborhoods["CRIME_COUNT_log"] = np.log(neighborhoods.CRIME_COUNT)
+    # log1p is used so a neighbourhood with no crimes maps to 0 instead of -inf, which would break the bins
+    crime_count_log = np.log1p(neighborhoods['CRIME_COUNT'].to_numpy(dtype=np.float64))
+    neighborhoods["CRIME_COUNT_log"] = crime_count_log
     #bins = list(neighborhoods.CRIME_COUNT.quantile([0, 0.125, 0.25, 0.375, 0.5, 0.625, 0.75, 0.875, 1.0]))
-    bins = list(neighborhoods.CRIME_COUNT_log.quantile([0, 0.20, 0.4, 0.6, 0.95, 1.0]))
+    bins = np.quantile(crime_count_log, [0, 0.20, 0.4, 0.6, 0.95, 1.0]).tolist()
 
+    # Simplify the boundaries (tolerance in degrees, roughly 10m) so the map has fewer vertices to draw
+    # Then serialize to GeoJSON once and share it between the choropleth and tooltip layers
+    neighborhoods['geometry'] = neighborhoods.geometry.simplify(0.0001, preserve_topology=True)
+    geo_dict = json.loads(neighborhoods.to_json())
 
     # Add the choropleth layer
     # https://stackoverflow.com/questions/69607123/attempting-to-use-choropleth-maps-in-folium-for-first-time-index-error
     Choropleth(
-        geo_data=neighborhoods,
+        geo_data=geo_dict,
         data=neighborhoods,
         columns=['NEIGHBOURHOOD', 'CRIME_COUNT_log'],
         key_on='feature.properties.NEIGHBOURHOOD',
@@ -116,7 +153,7 @@ def main():
     # Add a tooltip to display neighborhood names and crime counts
     # https://python-visualization.github.io/folium/latest/user_guide/geojson/geojson_popup_and_tooltip.html
     folium.GeoJson(
-        neighborhoods,
+        geo_dict,
         name='Neighborhoods',
         tooltip=folium.GeoJsonTooltip(
             fields=['NEIGHBOURHOOD', 'CRIME_COUNT'],